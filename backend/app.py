@@ -2,8 +2,8 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from backend.chat_query import retrieve, ask_gemini
-from fastapi.responses import FileResponse
+from backend.chat_query import ask_gemini, ask_gemini_stream
+from fastapi.responses import FileResponse, StreamingResponse
 
 class Query(BaseModel):
     query: str
@@ -27,7 +27,13 @@ async def root():
     return FileResponse("frontend/chatbot.html")
 
 @app.post("/api/ask")
-def ask(query: Query):
-    chunks = retrieve(query.query)
-    answer = ask_gemini(query.query, chunks)
+async def ask(query: Query):
+    # ask_gemini retrieves itself, after the greeting/menu shortcuts
+    answer = await ask_gemini(query.query)
     return {"answer": answer}
+
+@app.post("/api/ask/stream")
+async def ask_stream(query: Query):
+    return StreamingResponse(
+        ask_gemini_stream(query.query), media_type="text/html; charset=utf-8"
+    )
@@ -1,11 +1,18 @@
 # backend/chat_query.py
 import os
 import re
-import json
+import mmap
+import asyncio
+import sqlite3
+import hashlib
+import functools
+import threading
 import faiss
-import pickle
+import orjson
 import numpy as np
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
 
 from dotenv import load_dotenv
 import google.generativeai as genai
@@ -19,19 +26,94 @@ genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 # Create once per process to avoid re-instantiation overhead
 MODEL = genai.GenerativeModel("gemini-2.5-pro")
 
+# Blocking per-request work (query embeddings, FAISS search + row parsing) runs
+# here rather than on the event loop or asyncio's default executor, which is only
+# min(32, cpu_count + 4) threads on small hosts. All threads share the one client
+# created by genai.configure above and the cached read-only index.
+GENAI_WORKERS = int(os.getenv("GENAI_WORKERS", "16"))
+GENAI_EXECUTOR = ThreadPoolExecutor(max_workers=GENAI_WORKERS, thread_name_prefix="genai")
+
 INDEX_PATH = "embeddings/vector.index"
 META_PATH  = "embeddings/meta.jsonl"
+META_OFFSETS_PATH = "embeddings/meta.offsets.npy"
+
+# Number of IVF clusters scanned per query (ignored by flat indexes)
+NPROBE = 8
+
+# Loaded once per process on first use (see _get_index/_get_meta)
+_INDEX = None
+_META_MM = None
+_META_OFFSETS = None
+_LOAD_LOCK = threading.Lock()
+
+EMBED_MODEL = "models/embedding-001"
+
+# On-disk query-embedding cache shared by all worker processes (best effort:
+# a read-only or locked database just means a cache miss)
+QUERY_CACHE_PATH = "embeddings/query_cache.sqlite"
+# seconds to wait on another process's lock before treating it as a miss
+QUERY_CACHE_TIMEOUT = 0.05
+_QUERY_CACHE = None
+_QUERY_CACHE_LOCK = threading.Lock()
 
 HOMEPAGE_URL   = "https://iotmanufacturingtech.com"
 CONTACT_US_URL = "https://iotmanufacturingtech.com/contact-us/"
 
+# Compiled once; used by the link/HTML sanitizers below
+_BAD_SCHEME_RE = re.compile(r"^(javascript|data|vbscript|mailto):", re.I)
+_ANCHOR_OPEN_RE = re.compile(r"<a[\s>]", re.I)
+_ANCHOR_TAIL_RE = re.compile(r"<a?$", re.I)
+_ANCHOR_RE = re.compile(r'<a\s+href="(?P<href>[^"]+)"[^>]*>(?P<text>.*?)</a>', re.I | re.S)
+
+# Menu shortcuts: "1".."5" expand to these canned questions
+MENU_PROMPTS = {
+    "1": "Which IoT devices are suitable for predictive maintenance or asset tracking?",
+    "2": "Which platforms or protocols are supported and how do I set up a BLE gateway?",
+    "3": "Help me design a system diagram and bill of materials (BOM) for an IoT solution.",
+    "4": "How are IoT Manufacturing Tech solutions used in smart factories and automation?",
+    "5": "I have another IoT or asset tracking question. Please assist.",
+}
+
 # -----------------------
 # Embedding helpers
 # -----------------------
-def embed_query(query: str) -> np.ndarray:
-    """Return a float32 embedding vector for the query (L2 normalized)."""
+def _query_cache() -> sqlite3.Connection:
+    """Open (once) the sqlite table mapping query hash -> float32 bytes."""
+    global _QUERY_CACHE
+    if _QUERY_CACHE is None:
+        conn = sqlite3.connect(
+            QUERY_CACHE_PATH, timeout=QUERY_CACHE_TIMEOUT, check_same_thread=False
+        )
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vec BLOB)"
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        _QUERY_CACHE = conn
+    return _QUERY_CACHE
+
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query_bytes(query: str) -> bytes:
+    """Embed a query as raw float32 bytes, via the in-process LRU and sqlite cache."""
+    # model is part of the key so a model switch never serves stale vectors
+    key = hashlib.blake2b(f"{EMBED_MODEL}\0{query}".encode("utf-8")).hexdigest()
+    row = None
+    try:
+        with _QUERY_CACHE_LOCK:
+            row = _query_cache().execute(
+                "SELECT vec FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+    except sqlite3.Error:
+        pass
+    if row:
+        return row[0]
+
     res = genai.embed_content(
-        model="models/embedding-001",
+        model=EMBED_MODEL,
         content=query,
         task_type="retrieval_query"
     )
@@ -43,49 +125,199 @@ def embed_query(query: str) -> np.ndarray:
         vec = np.asarray(res["data"][0]["embedding"], dtype="float32")
     # faiss IndexFlatIP works best with normalized vectors
     faiss.normalize_L2(vec.reshape(1, -1))
-    return vec
+    buf = vec.tobytes()
+
+    try:
+        with _QUERY_CACHE_LOCK:
+            conn = _query_cache()
+            conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, vec) VALUES (?, ?)", (key, buf)
+            )
+            conn.commit()
+    except sqlite3.Error:
+        pass
+    return buf
+
 
+def embed_query(query: str) -> np.ndarray:
+    """Return a float32 embedding vector for the query (L2 normalized).
 
-def _load_meta() -> List[Dict]:
-    """Read aligned metadata rows: [{id,url,title,text}, ...]."""
-    with open(META_PATH, "r", encoding="utf-8") as f:
-        return [json.loads(line) for line in f]
+    Repeat queries are served from cache; the returned array is a private copy.
+    """
+    return np.frombuffer(_embed_query_bytes(query), dtype="float32").copy()
 
 
-def retrieve(query: str, k: int = 5) -> List[Dict]:
-    """Return top-k metadata rows (each has text,url,title,id)."""
-    index = faiss.read_index(INDEX_PATH)
-    meta  = _load_meta()
+async def embed_query_async(query: str) -> np.ndarray:
+    """Awaitable embed_query: the (cached) network call runs on GENAI_EXECUTOR."""
+    return await asyncio.get_running_loop().run_in_executor(GENAI_EXECUTOR, embed_query, query)
 
-    q = embed_query(query).reshape(1, -1)
-    # already normalized above, but harmless to call again
-    faiss.normalize_L2(q)
-    _, I = index.search(q, k)
+
+
+def _scan_offsets(mm: mmap.mmap) -> np.ndarray:
+    """Byte offset of every line start in mm, plus a final end offset."""
+    offsets = [0]
+    pos = mm.find(b"\n")
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = mm.find(b"\n", pos + 1)
+    if offsets[-1] != len(mm):  # last line without trailing newline
+        offsets.append(len(mm))
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def _preload(path: str) -> None:
+    """Ask the OS to pull a file into the page cache (no-op where unsupported)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, os.fstat(fd).st_size, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _get_index():
+    """Return the process-wide FAISS index, reading it from disk once.
+
+    The index is opened with IO_FLAG_MMAP | IO_FLAG_READ_ONLY. For IVF indexes
+    (as built by embed_chunks.py) the inverted lists are memory-mapped, so worker
+    processes share page-cache pages. A flat index, such as the committed
+    vector.index until it is rebuilt, is still read into a private per-process
+    buffer.
+    """
+    global _INDEX
+    if _INDEX is None:
+        with _LOAD_LOCK:
+            if _INDEX is None:
+                _preload(INDEX_PATH)
+                index = faiss.read_index(
+                    INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+                )
+                if hasattr(index, "nprobe"):
+                    index.nprobe = NPROBE
+                _INDEX = index
+    return _INDEX
+
+
+def _get_meta():
+    """Return (mmap of META_PATH, row offsets), opened once per process.
+
+    Row i spans mm[offsets[i]:offsets[i + 1]]. The offsets come from
+    META_OFFSETS_PATH (written by embed_chunks.py) when its end offset matches
+    the file size, else from a one-off newline scan.
+    """
+    global _META_MM, _META_OFFSETS
+    if _META_MM is None:
+        with _LOAD_LOCK:
+            if _META_MM is None:
+                with open(META_PATH, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offsets = None
+                if os.path.exists(META_OFFSETS_PATH):
+                    offsets = np.load(META_OFFSETS_PATH)
+                    # stale sidecar (meta.jsonl rebuilt/edited without it)
+                    if len(offsets) == 0 or int(offsets[-1]) != len(mm):
+                        offsets = None
+                _META_OFFSETS = offsets if offsets is not None else _scan_offsets(mm)
+                _META_MM = mm
+    return _META_MM, _META_OFFSETS
+
+
+def _meta_count() -> int:
+    """Number of metadata rows (aligned with index ids)."""
+    return len(_get_meta()[1]) - 1
+
+
+def _get_meta_row(i: int) -> Dict:
+    """Parse only metadata row i: {id,url,title,text}."""
+    mm, offsets = _get_meta()
+    return orjson.loads(mm[offsets[i]:offsets[i + 1]])
+
+
+def _search(q: np.ndarray, k: int) -> List[Dict]:
+    """Top-k metadata rows for an already L2-normalized query vector."""
+    index = _get_index()
+    n_meta = _meta_count()
+    _, I = index.search(q.reshape(1, -1), k)
 
     results = []
     for i in I[0]:
-        if 0 <= i < len(meta):
-            results.append(meta[i])
+        if 0 <= i < n_meta:
+            results.append(_get_meta_row(i))
     return results
 
+
+async def retrieve(query: str, k: int = 5) -> List[Dict]:
+    """Return top-k metadata rows (each has text,url,title,id).
+
+    The query embedding round-trip is started first so it overlaps with the
+    one-off index/metadata load on a cold process.
+    """
+    emb_task = asyncio.create_task(embed_query_async(query))
+    if _INDEX is None or _META_MM is None:
+        try:
+            await asyncio.to_thread(lambda: (_get_index(), _get_meta()))
+        except BaseException:
+            # missing/corrupt index or meta: don't leave the embed task orphaned
+            emb_task.cancel()
+            raise
+    # embed_query already L2-normalizes
+    q = await emb_task
+    return await asyncio.get_running_loop().run_in_executor(GENAI_EXECUTOR, _search, q, k)
+
+
+# Menu questions are fixed, so retrieve for them once up front (best effort:
+# without a key/network the entries are filled on first use instead)
+_MENU_RETRIEVED: Dict[str, List[Dict]] = {}
+for _key, _prompt in MENU_PROMPTS.items():
+    try:
+        _MENU_RETRIEVED[_key] = _search(embed_query(_prompt), 5)
+    except Exception:
+        pass
+
 # -----------------------
 # Link/HTML sanitizers
 # -----------------------
 def _sanitize_url(url: str) -> str:
-    """Keep only iotmanufacturingtech.com URLs; fallback to homepage."""
+    """Keep only iotmanufacturingtech.com URLs; fallback to homepage.
+
+    URLs already in the knowledge base are a set lookup; anything else (e.g.
+    links the model wrote itself) goes through _canonical_url.
+    """
+    if url in _ALLOWED_URLS:
+        return url
+    return _canonical_url(url)
+
+
+@functools.lru_cache(maxsize=4096)
+def _canonical_url(url: str) -> str:
+    """Strip query/fragment from URLs on our host; anything else becomes the homepage."""
     if not isinstance(url, str) or not url:
         return HOMEPAGE_URL
     url = url.strip()
     # block javascript/mailto/etc.
-    if re.match(r"^(javascript|data|vbscript|mailto):", url, re.I):
+    if _BAD_SCHEME_RE.match(url):
+        return HOMEPAGE_URL
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+    except ValueError:  # malformed netloc, e.g. an unbalanced "[" host
         return HOMEPAGE_URL
-    # allow only our domain
-    if "iotmanufacturingtech.com" not in url:
+    # allow only our domain (checked on the parsed host, not a substring)
+    if host != "iotmanufacturingtech.com" and not host.endswith(".iotmanufacturingtech.com"):
         return HOMEPAGE_URL
-    # drop fragments & query params
-    url = re.sub(r"#.*$", "", url)
-    url = re.sub(r"\?.*$", "", url)
-    return url
+    # drop fragments, query params and any user@ prefix
+    netloc = parts.netloc.rpartition("@")[2]
+    return urlunsplit(parts._replace(netloc=netloc, query="", fragment=""))
+
+
+def _kb_urls() -> frozenset:
+    """Every sanitized URL in the metadata, plus the homepage and Contact Us."""
+    urls = {_canonical_url(_get_meta_row(i).get("url", "")) for i in range(_meta_count())}
+    return frozenset(urls | {HOMEPAGE_URL, CONTACT_US_URL})
+
+
+_ALLOWED_URLS = _kb_urls()
 
 
 def _sanitize_anchor_html(html: str) -> str:
@@ -100,45 +332,64 @@ def _sanitize_anchor_html(html: str) -> str:
         return f'<a href="{safe}" target="_blank" rel="noopener noreferrer">{text}</a>'
 
     # Match <a href="...">...</a>
-    pattern = re.compile(r'<a\s+href="(?P<href>[^"]+)"[^>]*>(?P<text>.*?)</a>', re.I | re.S)
-    return pattern.sub(repl, html)
+    return _ANCHOR_RE.sub(repl, html)
 
 
-def _format_context(retrieved: List[Dict]) -> str:
-    """Join retrieved chunks with TITLE and URL headers."""
-    blocks = []
-    for r in retrieved:
-        title = (r.get("title") or "").strip()
-        url   = _sanitize_url(r.get("url", ""))
-        text  = (r.get("text") or "").strip()
-        blocks.append(f"TITLE: {title}\nURL: {url}\n\n{text}")
-    return "\n\n---\n\n".join(blocks)
-
+def _build_prompt_pieces(retrieved: List[Dict]) -> Tuple[str, List[str]]:
+    """One pass over retrieval: (context, allowed links).
 
-def _allowed_links(retrieved: List[Dict]) -> List[str]:
-    """Unique list of allowed, sanitized URLs derived from retrieval."""
-    seen, urls = set(), []
+    context joins chunks with TITLE and URL headers (chunks without text are
+    skipped); allowed links are the unique sanitized URLs, in first-seen order.
+    """
+    buf = []
+    append = buf.append
+    # dict keeps first-seen order while deduplicating
+    urls = {}
     for r in retrieved:
-        u = _sanitize_url(r.get("url", ""))
-        if u not in seen:
-            seen.add(u)
-            urls.append(u)
+        url = _sanitize_url(r.get("url", ""))
+        urls.setdefault(url, None)
+        text = (r.get("text") or "").strip()
+        if not text:
+            continue
+        append("TITLE: ")
+        append((r.get("title") or "").strip())
+        append("\nURL: ")
+        append(url)
+        append("\n\n")
+        append(text)
+        append("\n\n---\n\n")
     # Always allow homepage + contact as safe fallbacks
-    if HOMEPAGE_URL not in seen:
-        urls.append(HOMEPAGE_URL)
-    if CONTACT_US_URL not in seen:
-        urls.append(CONTACT_US_URL)
-    return urls
+    urls.setdefault(HOMEPAGE_URL, None)
+    urls.setdefault(CONTACT_US_URL, None)
+    return "".join(buf[:-1]), list(urls)
 
 # -----------------------
 # Main answer function
 # -----------------------
-def ask_gemini(query: str, retrieved_chunks: List[Dict]) -> str:
+_NO_ANSWER_REPLY = (
+    "I couldn’t find a specific answer in our knowledge base. "
+    f'Please try another query or reach us via <a href="{CONTACT_US_URL}" target="_blank" rel="noopener noreferrer">Contact Us</a>.'
+)
+
+_ERROR_REPLY = (
+    "Sorry — I hit a snag processing that. Please try again in a moment, or visit "
+    f'<a href="{CONTACT_US_URL}" target="_blank" rel="noopener noreferrer">Contact Us</a>.'
+)
+
+
+async def _prepare_prompt(
+    query: str, retrieved_chunks: Optional[List[Dict]] = None
+) -> Tuple[Optional[str], Optional[str]]:
     """
     Build a constrained prompt that:
       - Uses only provided context
       - Restricts links to an allowed list
       - Produces clean, natural answers
+
+    Greetings and menu shortcuts are handled before any retrieval; otherwise
+    retrieved_chunks defaults to retrieve(query).
+
+    Returns (reply, None) when the answer needs no model call, else (None, prompt).
     """
     normalized = query.strip().lower()
 
@@ -151,27 +402,23 @@ def ask_gemini(query: str, retrieved_chunks: List[Dict]) -> str:
             "2️⃣ How do I set up a BLE gateway?\n"
             "3️⃣ Can you help create a system diagram or BOM?\n"
             "4️⃣ What are real-world examples of smart factory deployments?"
-        )
+        ), None
 
     # Menu shortcuts (optional)
-    mapped_prompts = {
-        "1": "Which IoT devices are suitable for predictive maintenance or asset tracking?",
-        "2": "Which platforms or protocols are supported and how do I set up a BLE gateway?",
-        "3": "Help me design a system diagram and bill of materials (BOM) for an IoT solution.",
-        "4": "How are IoT Manufacturing Tech solutions used in smart factories and automation?",
-        "5": "I have another IoT or asset tracking question. Please assist.",
-    }
-    if normalized in mapped_prompts:
-        query = mapped_prompts[normalized]
-        retrieved_chunks = retrieve(query)
+    if normalized in MENU_PROMPTS:
+        query = MENU_PROMPTS[normalized]
+        retrieved_chunks = _MENU_RETRIEVED.get(normalized)
+        if retrieved_chunks is None:
+            retrieved_chunks = _MENU_RETRIEVED[normalized] = await retrieve(query)
+    elif retrieved_chunks is None:
+        retrieved_chunks = await retrieve(query)
 
     # If caller passed raw chunks list of strings, wrap them
     if retrieved_chunks and isinstance(retrieved_chunks[0], str):
         retrieved_chunks = [{"url": HOMEPAGE_URL, "title": "", "text": t} for t in retrieved_chunks]
 
     # Build prompt pieces
-    context = _format_context(retrieved_chunks)
-    allowed = _allowed_links(retrieved_chunks)
+    context, allowed = _build_prompt_pieces(retrieved_chunks)
     allowed_list = "\n".join(f"- {u}" for u in allowed)
 
     if not context.strip():
@@ -181,7 +428,7 @@ def ask_gemini(query: str, retrieved_chunks: List[Dict]) -> str:
             "smart-factory use cases, and related setups. Could you try rephrasing or ask about a "
             "specific product or scenario? You can also visit "
             f'<a href="{CONTACT_US_URL}" target="_blank" rel="noopener noreferrer">Contact Us</a> for direct help.'
-        )
+        ), None
 
     prompt = f"""
 You are a helpful assistant for IoT Manufacturing Tech. Answer clearly and naturally.
@@ -204,9 +451,17 @@ User question: {query}
 
 Your answer:
 """
+    return None, prompt
+
+
+async def ask_gemini(query: str, retrieved_chunks: Optional[List[Dict]] = None) -> str:
+    """Answer query from retrieved_chunks (see _prepare_prompt) as one HTML string."""
+    reply, prompt = await _prepare_prompt(query, retrieved_chunks)
+    if reply is not None:
+        return reply
 
     try:
-        resp = MODEL.generate_content(prompt)
+        resp = await MODEL.generate_content_async(prompt)
         # Gemini can return an empty candidate or no parts if it refused/finished early
         text = ""
         if hasattr(resp, "text") and isinstance(resp.text, str) and resp.text.strip():
@@ -222,10 +477,7 @@ Your answer:
             text = "\n".join(parts).strip()
 
         if not text:
-            return (
-                "I couldn’t find a specific answer in our knowledge base. "
-                f'Please try another query or reach us via <a href="{CONTACT_US_URL}" target="_blank" rel="noopener noreferrer">Contact Us</a>.'
-            )
+            return _NO_ANSWER_REPLY
 
         # Sanitize anchors to keep them on our domain & open in new tab
         text = _sanitize_anchor_html(text)
@@ -233,7 +485,64 @@ Your answer:
 
     except Exception as e:
         # Safe fallback on API issues
-        return (
-            "Sorry — I hit a snag processing that. Please try again in a moment, or visit "
-            f'<a href="{CONTACT_US_URL}" target="_blank" rel="noopener noreferrer">Contact Us</a>.'
-        )
+        return _ERROR_REPLY
+
+
+def _split_open_tag(buf: str) -> Tuple[str, str]:
+    """Split buf into (ready, pending), holding back an unfinished <a>...</a>.
+
+    Only anchors need to be seen whole by _sanitize_anchor_html, so other tags
+    (<abbr>, <aside>...) and plain "<" in text ("latency < 10 ms") stream through.
+    """
+    hold = len(buf)
+    # "<" or "<a" at the very end may become "<a href=..." in the next chunk
+    tail = _ANCHOR_TAIL_RE.search(buf)
+    if tail:
+        hold = tail.start()
+    opens = list(_ANCHOR_OPEN_RE.finditer(buf))
+    if opens:
+        a = opens[-1].start()
+        if "</a>" not in buf[a:].lower():
+            hold = min(hold, a)
+    return buf[:hold], buf[hold:]
+
+
+async def ask_gemini_stream(
+    query: str, retrieved_chunks: Optional[List[Dict]] = None
+) -> AsyncIterator[str]:
+    """Like ask_gemini, but yield sanitized HTML pieces as Gemini generates them.
+
+    Text is buffered only while an anchor tag is incomplete, so every <a> is
+    sanitized whole even when it spans stream chunks.
+    """
+    reply, prompt = await _prepare_prompt(query, retrieved_chunks)
+    if reply is not None:
+        yield reply
+        return
+
+    pending, sent = "", False
+    try:
+        resp = await MODEL.generate_content_async(prompt, stream=True)
+        async for chunk in resp:
+            try:
+                piece = chunk.text
+            except ValueError:  # chunk without text parts (e.g. safety/finish metadata)
+                continue
+            pending += piece
+            if not sent:
+                pending = pending.lstrip()
+            ready, pending = _split_open_tag(pending)
+            if ready:
+                sent = True
+                yield _sanitize_anchor_html(ready)
+    except Exception:
+        # Safe fallback on API issues
+        yield ("\n\n" if sent else "") + _ERROR_REPLY
+        return
+
+    pending = pending.rstrip()
+    if pending:
+        sent = True
+        yield _sanitize_anchor_html(pending)
+    if not sent:
+        yield _NO_ANSWER_REPLY
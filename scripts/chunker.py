@@ -1,23 +1,54 @@
 # scripts/chunker.py
 import json, re, os
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; split_text falls back to a plain list loop
+    njit = None
 
 IN_JSONL  = "data/site_content/pages.jsonl"
 OUT_JSONL = "data/chunks.jsonl"
 
 MAX_TOKENS = 450  # rough target; you can approximate by words/characters
 
+def _boundaries(lens, max_len):
+    """End index (exclusive) of each chunk, closing a chunk once it reaches max_len chars."""
+    ends = np.empty(len(lens), dtype=np.int32)
+    n, size = 0, 0
+    for i in range(len(lens)):
+        size += lens[i]
+        if size >= max_len:
+            ends[n] = i + 1
+            n += 1
+            size = 0
+    if len(lens) > 0 and (n == 0 or ends[n - 1] != len(lens)):
+        ends[n] = len(lens)
+        n += 1
+    return ends[:n]
+
+# Only worth it compiled: interpreted, a loop over numpy scalars is slower than lists
+boundaries = njit(cache=True)(_boundaries) if njit is not None else None
+
 def split_text(txt, max_len=1500):
     # simple paragraph-based splitter
     paras = [p.strip() for p in txt.split("\n") if p.strip()]
-    chunks, cur = [], []
-    size = 0
-    for p in paras:
-        size += len(p)
-        cur.append(p)
-        if size >= max_len:
-            chunks.append("\n\n".join(cur))
-            cur, size = [], 0
-    if cur: chunks.append("\n\n".join(cur))
+    if boundaries is None:
+        chunks, cur = [], []
+        size = 0
+        for p in paras:
+            size += len(p)
+            cur.append(p)
+            if size >= max_len:
+                chunks.append("\n\n".join(cur))
+                cur, size = [], 0
+        if cur: chunks.append("\n\n".join(cur))
+        return chunks
+    lens = np.fromiter((len(p) for p in paras), dtype=np.int32, count=len(paras))
+    chunks, start = [], 0
+    for end in boundaries(lens, max_len):
+        chunks.append("\n\n".join(paras[start:end]))
+        start = end
     return chunks
 
 os.makedirs("data", exist_ok=True)
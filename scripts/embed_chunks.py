@@ -1,5 +1,5 @@
 # scripts/embed_chunks.py
-import os, json, numpy as np, faiss
+import os, math, orjson, numpy as np, faiss
 from dotenv import load_dotenv
 import google.generativeai as genai
 
@@ -9,39 +9,66 @@ genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 IN_JSONL = "data/chunks.jsonl"
 IDX_PATH = "embeddings/vector.index"
 META_JSONL = "embeddings/meta.jsonl"
+META_OFFSETS = "embeddings/meta.offsets.npy"
+
+# IVF: ~4*sqrt(N) coarse clusters; chat_query.NPROBE of them are scanned per query
+MIN_NLIST = 16
 
 os.makedirs("embeddings", exist_ok=True)
 
-records = [json.loads(l) for l in open(IN_JSONL, encoding="utf-8")]
+records = [orjson.loads(l) for l in open(IN_JSONL, "rb")]
 texts = [r["text"] for r in records]
 
+def _embed_batch(batch_text):
+    res = genai.embed_content(
+        model="models/embedding-001",
+        content=batch_text,
+        task_type="retrieval_document",
+    )
+    # Gemini returns a dict per item; normalize to NxD
+    if isinstance(res, dict) and "embedding" in res:
+        emb = np.asarray(res["embedding"], dtype="float32")
+    else:
+        # new API returns {"data":[{"embedding":[...]}]}
+        data = res.get("data", [])
+        emb = np.asarray([d["embedding"] for d in data], dtype="float32")
+    if emb.ndim == 1:
+        emb = emb[None, :]
+    # a short/long batch would silently misalign vectors with meta rows
+    if emb.ndim != 2 or emb.shape[0] != len(batch_text):
+        raise ValueError(f"expected {len(batch_text)} embeddings, got shape {emb.shape}")
+    return emb
+
 def embed_many(strs, batch=32):
-    vecs = []
-    for i in range(0, len(strs), batch):
+    # first batch reveals D; fill one preallocated NxD array in place
+    first = _embed_batch(strs[:batch])
+    out = np.empty((len(strs), first.shape[1]), dtype="float32")
+    out[:len(first)] = first  # row count checked by _embed_batch
+    for i in range(batch, len(strs), batch):
         batch_text = strs[i:i+batch]
-        res = genai.embed_content(
-            model="models/embedding-001",
-            content=batch_text,
-            task_type="retrieval_document",
-        )
-        # Gemini returns a dict per item; normalize to NxD
-        if isinstance(res, dict) and "embedding" in res:
-            vecs.append(np.asarray(res["embedding"], dtype="float32"))
-        else:
-            # new API returns {"data":[{"embedding":[...]}]}
-            data = res.get("data", [])
-            vecs.extend([np.asarray(d["embedding"], dtype="float32") for d in data])
-    return np.vstack(vecs)
+        out[i:i+len(batch_text)] = _embed_batch(batch_text)
+    return out
 
 emb = embed_many(texts)
 d = emb.shape[1]
-index = faiss.IndexFlatIP(d)
 # normalize vectors for IP similarity
 faiss.normalize_L2(emb)
+# never ask for more clusters than there are vectors to train on
+nlist = min(len(records), max(MIN_NLIST, int(4 * math.sqrt(len(records)))))
+quantizer = faiss.IndexFlatIP(d)
+# 8-bit scalar quantization: 1 byte per dimension instead of 4 for fp32
+index = faiss.IndexIVFScalarQuantizer(
+    quantizer, d, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+)
+index.train(emb)
 index.add(emb)
 faiss.write_index(index, IDX_PATH)
 
-# save metadata aligned by row
-with open(META_JSONL, "w", encoding="utf-8") as f:
+# save metadata aligned by row, plus byte offsets so readers can parse single rows
+offsets = []
+with open(META_JSONL, "wb") as f:
     for r in records:
-        f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        offsets.append(f.tell())
+        f.write(orjson.dumps(r) + b"\n")
+    offsets.append(f.tell())
+np.save(META_OFFSETS, np.asarray(offsets, dtype=np.int64))
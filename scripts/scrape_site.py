@@ -1,65 +1,106 @@
-import os, re, json, time, urllib.parse
-import requests
-from bs4 import BeautifulSoup
-from collections import deque
+import os, re, json, asyncio, urllib.parse
+import aiohttp
+from lxml import html
 
 BASE = "https://iotmanufacturingtech.com"
 OUT_JSONL = "data/site_content/pages.jsonl"
-SEEN, QUEUE = set([BASE]), deque([BASE])
+HEADERS = {"User-Agent":"KB-bot/1.0"}
+WORKERS = 8   # concurrent fetches (also the connection pool size)
+DELAY = 0.5   # politeness pause per worker between requests
+SEEN = set([BASE])
+
+STRIP = "|".join(f"//{t}" for t in ["nav","footer","aside","script","style","noscript","form"])
 
 def same_domain(url):
-    return urllib.parse.urlparse(url).netloc.endswith("iotmanufacturingtech.com")
+    # exact host or a subdomain; a bare endswith() would also accept evil-iotmanufacturingtech.com
+    try:
+        host = urllib.parse.urlsplit(url).hostname or ""
+    except ValueError:
+        return False
+    return host == "iotmanufacturingtech.com" or host.endswith(".iotmanufacturingtech.com")
 
 def canonicalize(url):
     u = urllib.parse.urlsplit(url)
-    u = u._replace(fragment="", query="")  # drop # and ?params
+    # drop # and ?params; lowercase host so KB URLs match the chatbot's allow-list exactly
+    u = u._replace(netloc=u.netloc.lower(), fragment="", query="")
     return urllib.parse.urlunsplit(u)
 
-def extract(url):
-    r = requests.get(url, timeout=20, headers={"User-Agent":"KB-bot/1.0"})
-    r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+def extract(url, body):
+    """Parse a fetched page once; return ({url,title,text}, [outgoing links])."""
+    doc = html.fromstring(body)
+
+    # collect links before stripping nav/footer, which hold most internal links
+    links = []
+    for h in doc.xpath("//a/@href"):
+        try:
+            links.append(canonicalize(urllib.parse.urljoin(url, h)))
+        except ValueError:  # malformed href (e.g. "http://[foo"); skip just this link
+            continue
 
     # canonical URL if present
-    can = soup.find("link", rel="canonical")
-    canon = canonicalize(can["href"]) if can and can.get("href") else url
+    can = doc.xpath('//link[@rel="canonical"]/@href')
+    canon = canonicalize(can[0]) if can else url
+    if not same_domain(canon):
+        canon = canonicalize(url)
 
-    # remove nav/footers/aside/scripts
-    for sel in ["nav","footer","aside","script","style","noscript","form"]:
-        for t in soup.select(sel):
-            t.decompose()
+    # remove nav/footers/aside/scripts (and comments, which carry no page text)
+    for t in doc.xpath(STRIP + "|//comment()"):
+        if t.getparent() is not None:  # comments outside <html> have no parent
+            t.drop_tree()
 
-    title = (soup.title.string or "").strip() if soup.title else ""
+    title = (doc.findtext(".//title") or "").strip()
     # get main content text
-    body = soup.get_text(separator="\n")
-    # collapse whitespace
-    body = re.sub(r"\n{2,}", "\n\n", body).strip()
+    text = "\n".join(doc.itertext())
+    # collapse whitespace (lxml keeps the whitespace-only text between tags)
+    text = re.sub(r"(?:[ \t]*\n){2,}", "\n\n", text).strip()
+
+    return {"url": canon, "title": title, "text": text}, links
 
-    return {"url": canon, "title": title, "text": body}
+async def worker(session, queue, pages, lock):
+    while True:
+        url = await queue.get()
+        try:
+            async with session.get(url) as r:
+                r.raise_for_status()
+                body = await r.read()
+            page, links = extract(url, body)
+            await pages.put(page)
+            # enqueue before task_done() so queue.join() can't finish early
+            async with lock:
+                for href in links:
+                    if same_domain(href) and href not in SEEN:
+                        SEEN.add(href)
+                        queue.put_nowait(href)
+            await asyncio.sleep(DELAY)
+        except Exception as e:
+            print("skip", url, e)
+        finally:
+            queue.task_done()
 
-def enqueue_links(soup, base_url):
-    for a in soup.find_all("a", href=True):
-        href = urllib.parse.urljoin(base_url, a["href"])
-        href = canonicalize(href)
-        if same_domain(href) and href not in SEEN:
-            SEEN.add(href)
-            QUEUE.append(href)
+async def writer(pages, f):
+    # single writer so JSONL lines never interleave
+    while True:
+        page = await pages.get()
+        f.write(json.dumps(page, ensure_ascii=False) + "\n")
+        pages.task_done()
 
-def crawl():
+async def crawl():
     os.makedirs(os.path.dirname(OUT_JSONL), exist_ok=True)
+    queue, pages, lock = asyncio.Queue(), asyncio.Queue(), asyncio.Lock()
+    for url in SEEN:
+        queue.put_nowait(url)
+
+    connector = aiohttp.TCPConnector(limit=WORKERS, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=20)
     with open(OUT_JSONL, "w", encoding="utf-8") as f:
-        while QUEUE:
-            url = QUEUE.popleft()
-            try:
-                r = requests.get(url, timeout=20, headers={"User-Agent":"KB-bot/1.0"})
-                r.raise_for_status()
-                soup = BeautifulSoup(r.text, "html.parser")
-                page = extract(url)
-                f.write(json.dumps(page, ensure_ascii=False) + "\n")
-                enqueue_links(soup, url)
-                time.sleep(0.5)
-            except Exception as e:
-                print("skip", url, e)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS) as session:
+            tasks = [asyncio.create_task(worker(session, queue, pages, lock)) for _ in range(WORKERS)]
+            tasks.append(asyncio.create_task(writer(pages, f)))
+            await queue.join()
+            await pages.join()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 if __name__ == "__main__":
-    crawl()
+    asyncio.run(crawl())